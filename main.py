@@ -1,316 +1,750 @@
-from fastapi import FastAPI, UploadFile, File, Form, Request
-from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, FileResponse
+from fastapi import FastAPI, UploadFile, File, Form, Request, BackgroundTasks, Depends
+from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, ORJSONResponse, FileResponse, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
+from jinja2 import FileSystemBytecodeCache
 from pathlib import Path
 import io
-from pdf_generator import PDFGenerator
-from typing import Optional
-import yaml
+from pdf_generator import PDFGenerator, build_codehilite_css, load_preset_file, theme_background_color
+from typing import Annotated, Optional, BinaryIO, NamedTuple
+from pydantic import BaseModel, Field
 import json
-import uuid
+import secrets
 import os
+import sys
+import stat
+import copy
+import logging
+import asyncio
+import shutil
+import hashlib
+import functools
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 
-app = FastAPI(title="Markdown to PDF Converter")
+try:
+    import orjson
+except ImportError:  # Optional speedup; the stdlib json module is used without it
+    orjson = None
 
-templates = Jinja2Templates(directory="templates")
+logging.basicConfig(level=logging.INFO, format="%(levelname)s:     %(name)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+# Serialize API responses with orjson when it's installed
+APIResponse = ORJSONResponse if orjson is not None else JSONResponse
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build the theme gallery CSS before serving so no request pays for it
+    get_themes_with_css()
+    # Refresh the presets' JSON copies so the first preset request skips YAML
+    get_preset_index(get_pdf_generator())
+    # Resolve the configured theme's code block background ahead of the first preview
+    theme_background_color(get_pdf_generator().config.get('codehilite_theme', 'default'))
+    yield
 
-UPLOAD_DIR = "temp_uploads"
+app = FastAPI(title="Markdown to PDF Converter", default_response_class=APIResponse, lifespan=lifespan)
+
+templates = Jinja2Templates(directory="templates")
+# Templates only change between releases, so compile them once and skip
+# Jinja's per-render mtime check (restart the server after editing them)
+templates.env.auto_reload = False
+# Reuse compiled template bytecode across restarts (keyed on source checksum)
+templates.env.bytecode_cache = FileSystemBytecodeCache()
+_TPL_INDEX = templates.get_template("index.html")
+_TPL_PREVIEW = templates.get_template("preview.html")
+_TPL_THEMES = templates.get_template("theme_preview.html")
+
+def _private_shm_dir(path: str) -> Optional[str]:
+    """Create (or reuse) a per-user upload dir on /dev/shm, or None if it can't be trusted"""
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    except OSError as e:
+        logger.warning("Could not create %s: %s", path, e)
+        return None
+
+    # /dev/shm is world-writable: refuse a symlink or a directory another user created
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        logger.warning("Refusing upload dir %s: not a directory owned by this user", path)
+        return None
+    if stat.S_IMODE(st.st_mode) != 0o700:
+        os.chmod(path, 0o700)
+    return path
+
+def ensure_upload_dir():
+    """Create UPLOAD_DIR if it is missing (re-checking ownership for the /dev/shm one)"""
+    if UPLOAD_DIR == _SHM_UPLOAD_DIR:
+        if _private_shm_dir(UPLOAD_DIR) is None:
+            raise RuntimeError(f"Upload directory {UPLOAD_DIR} is not safe to use")
+    else:
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+# Uploads are short-lived, so on Linux keep them on tmpfs (/dev/shm) by default,
+# in a private per-user directory. Override with MD2PDF_UPLOAD_DIR.
+_SHM_UPLOAD_DIR = None
+if sys.platform.startswith("linux") and os.path.isdir("/dev/shm"):
+    _SHM_UPLOAD_DIR = f"/dev/shm/md2pdf-{os.getuid()}"
+UPLOAD_DIR = os.environ.get("MD2PDF_UPLOAD_DIR")
+if UPLOAD_DIR is None:
+    # Only set up the /dev/shm directory when it's actually going to be used
+    UPLOAD_DIR = (_private_shm_dir(_SHM_UPLOAD_DIR) if _SHM_UPLOAD_DIR else None) or "temp_uploads"
+ensure_upload_dir()
+
+# Uploads are copied to disk in chunks of this size rather than read into memory
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Shared PDFGenerator, rebuilt only when its config file changes on disk
+_PDF_GEN_CACHE = {"mtime": 0, "gen": None}
+
+def get_pdf_generator() -> PDFGenerator:
+    """Return the cached PDFGenerator, reloading it if config.yaml was modified"""
+    gen = _PDF_GEN_CACHE["gen"]
+    if gen is not None:
+        try:
+            if os.stat(gen.config_path).st_mtime_ns == _PDF_GEN_CACHE["mtime"]:
+                return gen
+        except FileNotFoundError:
+            pass
+
+    gen = PDFGenerator()
+    _PDF_GEN_CACHE["gen"] = gen
+    _PDF_GEN_CACHE["mtime"] = os.stat(gen.config_path).st_mtime_ns
+    return gen
+
+async def shared_pdf_generator() -> PDFGenerator:
+    """Route dependency for the shared generator (async, so it runs without a thread hop)"""
+    return get_pdf_generator()
+
+# Annotated dependency for routes that use the shared generator
+SharedPDFGenerator = Annotated[PDFGenerator, Depends(shared_pdf_generator)]
+
+# Serializes config.yaml writes now that they run in worker threads
+_CONFIG_WRITE_LOCK = asyncio.Lock()
+
+def mark_config_saved(gen: PDFGenerator):
+    """Record a save made through the shared generator so it isn't rebuilt needlessly"""
+    if gen is _PDF_GEN_CACHE["gen"]:
+        _PDF_GEN_CACHE["mtime"] = os.stat(gen.config_path).st_mtime_ns
+
+# Rendered markdown HTML, keyed by (content hash, config hash)
+_RENDER_CACHE: OrderedDict[tuple[str, str], str] = OrderedDict()
+_RENDER_CACHE_SIZE = 64
+
+# Fully rendered preview pages, keyed by (file_id, upload mtime, config hash)
+_PREVIEW_CACHE: OrderedDict[tuple[str, int, str], bytes] = OrderedDict()
+_PREVIEW_CACHE_SIZE = 32
+
+@functools.lru_cache(maxsize=32)
+def _parse_preset_file(path: str, mtime_ns: int) -> dict:
+    """Parse a preset file (mtime_ns only takes part in the cache key)"""
+    return load_preset_file(Path(path))
+
+def load_preset_cached(path) -> dict:
+    """Load a preset file, re-parsing it only when its mtime changes"""
+    mtime_ns = os.stat(path).st_mtime_ns
+    # Callers modify the result, so hand out a copy of the cached data
+    return copy.deepcopy(_parse_preset_file(str(path), mtime_ns))
+
+def preset_dir_mtimes(pdf_gen: PDFGenerator) -> tuple[int, int]:
+    """Modification times of the user and factory preset directories"""
+    try:
+        return (os.stat(pdf_gen.user_presets_dir).st_mtime_ns,
+                os.stat(pdf_gen.factory_presets_dir).st_mtime_ns)
+    except FileNotFoundError:
+        # Removed while the server was running: recreate them (and the factory presets)
+        pdf_gen.restore_presets_directory()
+        return (os.stat(pdf_gen.user_presets_dir).st_mtime_ns,
+                os.stat(pdf_gen.factory_presets_dir).st_mtime_ns)
+
+class PresetEntry(NamedTuple):
+    path: Path
+    metadata: dict
+    is_factory: bool
+
+# Preset slug -> PresetEntry across both preset directories, plus the views
+# derived from it. Factory presets win on a slug collision, since the shadowed
+# user preset can't be loaded or deleted. Rebuilt whenever a preset directory
+# changes; the preset routes invalidate it after writing a preset in place.
+_PRESET_INDEX: dict = {"mtimes": None, "entries": {}, "listing": None, "factory_names": {}}
+
+def invalidate_preset_index():
+    """Force the next preset lookup to re-list the preset directories"""
+    _PRESET_INDEX["mtimes"] = None
+
+def get_preset_index(pdf_gen: PDFGenerator) -> dict:
+    """Return the preset index, re-listing only after the presets change"""
+    mtimes = preset_dir_mtimes(pdf_gen)
+    if mtimes != _PRESET_INDEX["mtimes"]:
+        presets = pdf_gen.list_presets()
+        # User presets go in first so factory presets overwrite them
+        entries = {}
+        for preset_dir, key in ((pdf_gen.user_presets_dir, 'user'),
+                                (pdf_gen.factory_presets_dir, 'factory')):
+            for preset in presets[key]:
+                entries[preset['slug']] = PresetEntry(
+                    preset_dir / f"{preset['slug']}.yaml", preset, preset['is_factory'])
+
+        # list_presets() already sorts both lists by name
+        _PRESET_INDEX["entries"] = entries
+        _PRESET_INDEX["listing"] = {
+            'factory': presets['factory'],
+            'user': [p for p in presets['user'] if not entries[p['slug']].is_factory],
+        }
+        _PRESET_INDEX["factory_names"] = {p['name'].lower(): p['name'] for p in presets['factory']}
+        _PRESET_INDEX["mtimes"] = mtimes
+    return _PRESET_INDEX
+
+def get_presets(pdf_gen: PDFGenerator) -> dict:
+    """Return the factory and user presets in list_presets() form"""
+    return get_preset_index(pdf_gen)["listing"]
+
+def find_preset_path(slug: str) -> Optional[Path]:
+    """Return the file of a factory or user preset, or None if there is none"""
+    entry = get_preset_index(get_pdf_generator())["entries"].get(slug)
+    return entry.path if entry is not None else None
+
+def is_factory_preset(pdf_gen: PDFGenerator, slug: str) -> bool:
+    """Whether slug names a factory preset"""
+    entry = get_preset_index(pdf_gen)["entries"].get(slug)
+    return entry is not None and entry.is_factory
+
+def get_factory_preset_name(pdf_gen: PDFGenerator, name: str) -> Optional[str]:
+    """Return the factory preset display name matching name case-insensitively"""
+    return get_preset_index(pdf_gen)["factory_names"].get(name.lower())
+
+def get_preset_name(pdf_gen: PDFGenerator, slug: str, user_only: bool = False) -> str:
+    """Return a preset's display name, falling back to its slug"""
+    entry = get_preset_index(pdf_gen)["entries"].get(slug)
+    if entry is None:
+        return slug
+    if user_only and entry.is_factory:
+        # A user preset shadowed by a factory one isn't in the index
+        user_path = pdf_gen.user_presets_dir / f"{slug}.yaml"
+        try:
+            metadata = load_preset_cached(user_path).get('_metadata') or {}
+        except FileNotFoundError:
+            return slug
+        return metadata.get('name', slug.replace('-', ' ').title())
+    return entry.metadata['name']
+
+def json_loads(raw):
+    """Parse JSON from str or bytes, with orjson when it's installed"""
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+def json_dumps(obj, sort_keys: bool = False) -> bytes:
+    """Serialize compact JSON to bytes, with orjson when it's installed"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(obj, option=option, default=str)
+    return json.dumps(obj, sort_keys=sort_keys, separators=(',', ':'), default=str).encode()
+
+def config_fingerprint(config: dict) -> str:
+    """Return a stable hash of a config dict for use in cache keys"""
+    return hashlib.blake2b(json_dumps(config, sort_keys=True), digest_size=16).hexdigest()
+
+def build_html_body(pdf_gen: PDFGenerator, markdown_content: str) -> str:
+    """Convert markdown to HTML and apply custom classes and code block styling"""
+    html_body = pdf_gen.markdown_to_html(markdown_content)
+    try:
+        html_body = pdf_gen.postprocess_html(html_body)
+    except Exception as e:
+        # Fall back to the unstyled HTML without parsing the markdown again
+        logger.warning("Error applying custom classes: %s", e)
+    return html_body
+
+async def render_markdown(pdf_gen: PDFGenerator, markdown_content: str) -> str:
+    """Render markdown to styled HTML, reusing the cached result for identical input"""
+    # Render from a snapshot: the shared generator's config can be replaced or
+    # updated in place while the worker thread runs, and the result has to
+    # match the fingerprint it's cached under
+    snapshot = copy.copy(pdf_gen)
+    snapshot.config = copy.deepcopy(pdf_gen.config)
+
+    content_key = hashlib.blake2b(markdown_content.encode(), digest_size=16).hexdigest()
+    key = (content_key, config_fingerprint(snapshot.config))
+
+    html_body = _RENDER_CACHE.get(key)
+    if html_body is not None:
+        _RENDER_CACHE.move_to_end(key)
+        return html_body
+
+    # Rendering is CPU-bound, so keep it off the event loop. The cache itself
+    # is only touched from the loop.
+    html_body = await asyncio.to_thread(build_html_body, snapshot, markdown_content)
+
+    _RENDER_CACHE[key] = html_body
+    if len(_RENDER_CACHE) > _RENDER_CACHE_SIZE:
+        _RENDER_CACHE.popitem(last=False)
+    return html_body
+
+# Changes on every start, so pages cached by the browser are revalidated
+# against freshly loaded templates after a restart or upgrade
+_ETAG_SALT = secrets.token_hex(8)
+
+def preview_etag(cache_key: tuple) -> str:
+    """Build a strong ETag from a preview cache key"""
+    digest = hashlib.sha1(repr((_ETAG_SALT, cache_key)).encode()).hexdigest()
+    return f'"{digest}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Check whether the request's If-None-Match header covers this ETag"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+# Parsed temporary configs by file_id as (expiry, config), so previews skip the
+# disk + JSON round-trip. Expired entries fall back to the on-disk copy.
+_TEMP_CONFIGS: dict[str, tuple[float, dict]] = {}
+_TEMP_CONFIGS_MAX = 32
+_TEMP_CONFIG_TTL = 3600  # seconds
+
+def store_temp_config(file_id: str, config: dict):
+    """Keep a parsed temp config in memory for _TEMP_CONFIG_TTL seconds"""
+    if len(_TEMP_CONFIGS) >= _TEMP_CONFIGS_MAX:
+        _TEMP_CONFIGS.pop(next(iter(_TEMP_CONFIGS)))
+    _TEMP_CONFIGS[file_id] = (time.monotonic() + _TEMP_CONFIG_TTL, config)
+
+def get_temp_config(file_id: str) -> Optional[dict]:
+    """Return the in-memory temp config for file_id if it hasn't expired"""
+    entry = _TEMP_CONFIGS.get(file_id)
+    if entry is None:
+        return None
+    if entry[0] <= time.monotonic():
+        _TEMP_CONFIGS.pop(file_id, None)
+        return None
+    return entry[1]
+
+def parse_temp_config(raw: str) -> Optional[dict]:
+    """Parse temp_config JSON, returning None if it isn't a usable config"""
+    try:
+        config = json_loads(raw)
+    except ValueError:
+        return None
+    if not isinstance(config, dict) or 'custom_classes' not in config:
+        return None
+    return config
+
+# file_id of the most recent upload, the only one cleanup_old_files keeps
+_LATEST_FILE_ID: Optional[str] = None
+
+def evict_stale_uploads(keep: str):
+    """Drop in-memory state for every upload but `keep`
+
+    The caches are only touched from the event loop, so call this from a
+    handler, not from the background file cleanup (which runs in a thread).
+    """
+    now = time.monotonic()
+    for file_id, (expires, _) in list(_TEMP_CONFIGS.items()):
+        if file_id != keep or expires <= now:
+            _TEMP_CONFIGS.pop(file_id, None)
+    for cache_key in list(_PREVIEW_CACHE):
+        if cache_key[0] != keep:
+            _PREVIEW_CACHE.pop(cache_key, None)
 
 def cleanup_old_files():
-    """Remove all files from temp_uploads to keep only the most recent upload"""
-    if not os.path.exists(UPLOAD_DIR):
-        return
-
-    for filename in os.listdir(UPLOAD_DIR):
-        file_path = os.path.join(UPLOAD_DIR, filename)
-        if os.path.isfile(file_path):
-            os.remove(file_path)
-
-def save_uploaded_file(content: bytes, original_filename: str) -> str:
-    """Save uploaded file and return unique file_id"""
-    cleanup_old_files()
-    
-    file_id = str(uuid.uuid4())
+    """Remove all files from temp_uploads except those of the most recent upload"""
+    keep = _LATEST_FILE_ID
+
+    # Open the directory itself (never through a symlink) and work relative to
+    # that fd, so a swapped-in path can't redirect the unlinks elsewhere
+    use_dir_fd = os.unlink in os.supports_dir_fd and os.scandir in os.supports_fd
+    dir_fd = None
+    try:
+        if use_dir_fd:
+            dir_fd = os.open(UPLOAD_DIR, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0)
+                             | getattr(os, "O_NOFOLLOW", 0))
+            if UPLOAD_DIR == _SHM_UPLOAD_DIR and os.fstat(dir_fd).st_uid != os.getuid():
+                logger.warning("Skipping cleanup of %s: not owned by this user", UPLOAD_DIR)
+                return
+
+        # Collect everything first, then unlink in one pass. DirEntry type bits come
+        # from the directory listing, so is_file() doesn't stat each entry.
+        with os.scandir(dir_fd if dir_fd is not None else UPLOAD_DIR) as entries:
+            stale_names = [
+                entry.name for entry in entries
+                if entry.is_file(follow_symlinks=False) and not (keep and entry.name.startswith(keep))
+            ]
+
+        for name in stale_names:
+            try:
+                if dir_fd is not None:
+                    os.unlink(name, dir_fd=dir_fd)
+                else:
+                    os.unlink(os.path.join(UPLOAD_DIR, name))
+            except FileNotFoundError:
+                pass  # Already removed by a concurrent cleanup
+    except FileNotFoundError:
+        # The upload dir was removed (e.g. /dev/shm was cleared), recreate it
+        ensure_upload_dir()
+    except OSError as e:
+        # e.g. ELOOP: UPLOAD_DIR was replaced by a symlink
+        logger.warning("Skipping cleanup of %s: %s", UPLOAD_DIR, e)
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+
+def _private_opener(path: str, flags: int) -> int:
+    """Open upload files so they are only readable by the server's user"""
+    return os.open(path, flags, 0o600)
+
+def save_uploaded_file(source: BinaryIO, original_filename: str) -> str:
+    """Stream uploaded file to disk and return unique file_id"""
+    global _LATEST_FILE_ID
+
+    file_id = secrets.token_hex(16)
+    _LATEST_FILE_ID = file_id
     file_extension = Path(original_filename).suffix
     stored_filename = f"{file_id}{file_extension}"
     file_path = os.path.join(UPLOAD_DIR, stored_filename)
     metadata_path = os.path.join(UPLOAD_DIR, f"{file_id}.meta")
-    
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
-    with open(file_path, 'wb') as f:
-        f.write(content)
 
-    with open(metadata_path, 'w') as f:
-        f.write(original_filename)
+    try:
+        f = open(file_path, 'wb', opener=_private_opener)
+    except FileNotFoundError:
+        # The upload dir was removed (e.g. /dev/shm was cleared), recreate it
+        ensure_upload_dir()
+        f = open(file_path, 'wb', opener=_private_opener)
+    with f:
+        shutil.copyfileobj(source, f, UPLOAD_CHUNK_SIZE)
+
+    # Record the extension so the file can be opened directly by path later
+    write_text_file(metadata_path, json_dumps({"original": original_filename, "ext": file_extension}).decode())
     
     return file_id
 
+def write_text_file(path: str, text: str):
+    """Atomically write a small sidecar file next to an upload"""
+    # Write to a temporary name and rename it into place, so readers
+    # never see a half-written file
+    tmp_path = f"{path}.tmp"
+    # Sidecars are tiny, so write them with raw os calls instead of a file object
+    fd = _private_opener(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    try:
+        data = memoryview(text.encode())
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, path)
+
 def get_file_content(file_id: str) -> tuple[str, str]:
     """Get file content and original filename by file_id"""
     metadata_path = os.path.join(UPLOAD_DIR, f"{file_id}.meta")
-    original_filename = None
 
-    if os.path.exists(metadata_path):
-        with open(metadata_path, 'r') as f:
-            original_filename = f.read().strip()
+    try:
+        with open(metadata_path, 'rb') as f:
+            metadata = json_loads(f.read())
+    except (FileNotFoundError, ValueError):
+        raise FileNotFoundError(f"File with ID {file_id} not found")
+
+    original_filename = metadata["original"]
+    file_path = os.path.join(UPLOAD_DIR, f"{file_id}{metadata['ext']}")
+    with open(file_path, 'r', encoding='utf-8') as f:
+        content = f.read()
 
-    for filename in os.listdir(UPLOAD_DIR):
-        if filename.startswith(file_id) and not filename.endswith(('.meta', '.tempconfig', '.preset')):
-            file_path = os.path.join(UPLOAD_DIR, filename)
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+    return content, original_filename
 
-            display_filename = original_filename if original_filename else filename
-            return content, display_filename
+# The installed Pygments themes don't change at runtime, so list them once
+AVAILABLE_THEMES = tuple(PDFGenerator.get_available_themes())
 
-    raise FileNotFoundError(f"File with ID {file_id} not found")
+# Maps theme-name characters that aren't valid in a CSS class name to underscores
+_SCOPE_TRANS = str.maketrans({'.': '_', '-': '_'})
+
+def _scoped_theme_css(theme: str) -> tuple[str, Optional[str]]:
+    """Generate one theme's CSS scoped to its gallery card"""
+    try:
+        # Create scope prefix by replacing special characters
+        scope_class = f".theme-{theme.translate(_SCOPE_TRANS)}"
+        return theme, build_codehilite_css(theme, scope_class)
+    except Exception as e:
+        logger.warning("Error generating CSS for theme %s: %s", theme, e)
+        return theme, None
+
+def build_themes_with_css() -> dict:
+    """Generate scoped CSS for every available Pygments theme"""
+    # Pygments formatting is pure Python and holds the GIL, and the whole build
+    # takes about 0.1 s, so a plain loop beats any pool
+    results = [_scoped_theme_css(theme) for theme in AVAILABLE_THEMES]
+    return {theme: css for theme, css in results if css is not None}
+
+@functools.cache
+def get_themes_with_css() -> dict:
+    """Return scoped CSS for every theme, built once per process"""
+    # The installed Pygments themes don't change at runtime
+    return build_themes_with_css()
+
+# Sample Python code for the theme gallery (with syntax highlighting markup)
+SAMPLE_CODE = '''<span class="k">def</span> <span class="nf">fibonacci</span><span class="p">(</span><span class="n">n</span><span class="p">):</span>
+    <span class="k">if</span> <span class="n">n</span> <span class="o">&lt;=</span> <span class="mi">1</span><span class="p">:</span>
+        <span class="k">return</span> <span class="n">n</span>
+    <span class="k">return</span> <span class="n">fibonacci</span><span class="p">(</span><span class="n">n</span><span class="o">-</span><span class="mi">1</span><span class="p">)</span> <span class="o">+</span> <span class="n">fibonacci</span><span class="p">(</span><span class="n">n</span><span class="o">-</span><span class="mi">2</span><span class="p">)</span>
+
+<span class="nb">print</span><span class="p">(</span><span class="n">fibonacci</span><span class="p">(</span><span class="mi">10</span><span class="p">))</span>'''
+
+@functools.cache
+def render_theme_preview() -> tuple[bytes, str]:
+    """Render the theme gallery page and its ETag"""
+    page = _TPL_THEMES.render(
+        {
+            "themes": get_themes_with_css(),
+            "sample_code": SAMPLE_CODE
+        }
+    ).encode()
+    return page, f'"{hashlib.blake2b(page, digest_size=16).hexdigest()}"'
 
 @app.get("/", response_class=HTMLResponse)
-async def home(request: Request):
-    pdf_gen = PDFGenerator()
-    available_themes = pdf_gen.get_available_themes()
-    return templates.TemplateResponse(
-        "index.html",
+async def home(request: Request, pdf_gen: SharedPDFGenerator):
+    return HTMLResponse(_TPL_INDEX.render(
         {
-            "request": request,
             "config": pdf_gen.config,
-            "available_themes": available_themes
+            "available_themes": AVAILABLE_THEMES
         }
-    )
+    ))
 
 @app.get("/api/config")
-async def get_config():
-    pdf_gen = PDFGenerator()
+async def get_config(pdf_gen: SharedPDFGenerator):
     return pdf_gen.config
 
+# Factory defaults never change at runtime, so serialize the reset payload once
+_FACTORY_DEFAULTS = PDFGenerator.get_default_config()
+_FACTORY_RESET_BODY = json_dumps({
+    key: _FACTORY_DEFAULTS[key]
+    for key in ('prose_size', 'prose_color', 'codehilite_theme', 'codehilite_container', 'custom_classes')
+})
+
 @app.get("/api/config/factory-reset")
 async def get_factory_config():
     """Return factory default configuration"""
-    full_config = PDFGenerator.get_default_config()
-    return {
-        'prose_size': full_config['prose_size'],
-        'prose_color': full_config['prose_color'],
-        'codehilite_theme': full_config['codehilite_theme'],
-        'codehilite_container': full_config['codehilite_container'],
-        'custom_classes': full_config['custom_classes']
-    }
+    return Response(content=_FACTORY_RESET_BODY, media_type="application/json")
+
+# Accepted upload extensions (compared against the lowercased suffix)
+MARKDOWN_EXTENSIONS = frozenset({'.md', '.markdown'})
+YAML_EXTENSIONS = frozenset({'.yaml', '.yml'})
+
+# Elements that accept custom classes, posted as "<element>_classes" form fields
+CUSTOM_CLASS_ELEMENTS = (
+    "h1", "h2", "h3", "h4", "h5", "h6", "p", "a", "code", "pre", "blockquote",
+    "table", "thead", "tbody", "tr", "td", "th", "ul", "ol", "li", "img", "hr"
+)
+
+class ConfigForm(BaseModel):
+    """Settings form fields, validated by FastAPI in a single pass"""
+    # Form models don't treat an empty field as missing like Form(...) did
+    prose_size: Annotated[str, Field(min_length=1)]
+    prose_color: str = ""
+    codehilite_theme: str = "default"
+    codehilite_auto_bg: bool = True
+    codehilite_custom_bg: str = ""
+    codehilite_wrapper_classes: str = ""
+    h1_classes: str = ""
+    h2_classes: str = ""
+    h3_classes: str = ""
+    h4_classes: str = ""
+    h5_classes: str = ""
+    h6_classes: str = ""
+    p_classes: str = ""
+    a_classes: str = ""
+    code_classes: str = ""
+    pre_classes: str = ""
+    blockquote_classes: str = ""
+    table_classes: str = ""
+    thead_classes: str = ""
+    tbody_classes: str = ""
+    tr_classes: str = ""
+    td_classes: str = ""
+    th_classes: str = ""
+    ul_classes: str = ""
+    ol_classes: str = ""
+    li_classes: str = ""
+    img_classes: str = ""
+    hr_classes: str = ""
+
+    def to_config(self) -> dict:
+        """Convert the flat form fields into the nested config structure"""
+        return {
+            "prose_size": self.prose_size,
+            "prose_color": self.prose_color,
+            "codehilite_theme": self.codehilite_theme,
+            "codehilite_container": {
+                "auto_background": self.codehilite_auto_bg,
+                "custom_background": self.codehilite_custom_bg,
+                "wrapper_classes": self.codehilite_wrapper_classes
+            },
+            "custom_classes": {
+                element: getattr(self, f"{element}_classes")
+                for element in CUSTOM_CLASS_ELEMENTS
+            }
+        }
+
+class PresetForm(ConfigForm):
+    """Settings form fields plus the name and description of a new preset"""
+    name: Annotated[str, Field(min_length=1)]
+    description: str = ""
 
 @app.post("/api/config")
-async def update_config(
-    prose_size: str = Form(...),
-    prose_color: str = Form(""),
-    codehilite_theme: str = Form("default"),
-    codehilite_auto_bg: bool = Form(True),
-    codehilite_custom_bg: str = Form(""),
-    codehilite_wrapper_classes: str = Form(""),
-    h1_classes: str = Form(""),
-    h2_classes: str = Form(""),
-    h3_classes: str = Form(""),
-    h4_classes: str = Form(""),
-    h5_classes: str = Form(""),
-    h6_classes: str = Form(""),
-    p_classes: str = Form(""),
-    a_classes: str = Form(""),
-    code_classes: str = Form(""),
-    pre_classes: str = Form(""),
-    blockquote_classes: str = Form(""),
-    table_classes: str = Form(""),
-    thead_classes: str = Form(""),
-    tbody_classes: str = Form(""),
-    tr_classes: str = Form(""),
-    td_classes: str = Form(""),
-    th_classes: str = Form(""),
-    ul_classes: str = Form(""),
-    ol_classes: str = Form(""),
-    li_classes: str = Form(""),
-    img_classes: str = Form(""),
-    hr_classes: str = Form("")
-):
-    updates = {
-        "prose_size": prose_size,
-        "prose_color": prose_color,
-        "codehilite_theme": codehilite_theme,
-        "codehilite_container": {
-            "auto_background": codehilite_auto_bg,
-            "custom_background": codehilite_custom_bg,
-            "wrapper_classes": codehilite_wrapper_classes
-        },
-        "custom_classes": {
-            "h1": h1_classes,
-            "h2": h2_classes,
-            "h3": h3_classes,
-            "h4": h4_classes,
-            "h5": h5_classes,
-            "h6": h6_classes,
-            "p": p_classes,
-            "a": a_classes,
-            "code": code_classes,
-            "pre": pre_classes,
-            "blockquote": blockquote_classes,
-            "table": table_classes,
-            "thead": thead_classes,
-            "tbody": tbody_classes,
-            "tr": tr_classes,
-            "td": td_classes,
-            "th": th_classes,
-            "ul": ul_classes,
-            "ol": ol_classes,
-            "li": li_classes,
-            "img": img_classes,
-            "hr": hr_classes
-        }
-    }
+async def update_config(form: Annotated[ConfigForm, Form()], pdf_gen: SharedPDFGenerator):
+    updates = form.to_config()
 
-    pdf_gen = PDFGenerator()
-    pdf_gen.update_config(updates)
+    async with _CONFIG_WRITE_LOCK:
+        await asyncio.to_thread(pdf_gen.update_config, updates)
+        mark_config_saved(pdf_gen)
     return {"status": "success", "message": "Configuration updated"}
 
+def load_preset_config(slug: str) -> Optional[dict]:
+    """Return a preset's config without its metadata, or None if there is no such preset"""
+    preset_path = find_preset_path(slug)
+    if preset_path is None:
+        return None
+    preset_data = load_preset_cached(preset_path)
+    preset_data.pop('_metadata', None)
+    return preset_data
+
+def read_upload_config(file_id: str) -> Optional[dict]:
+    """Return the config an upload was saved with on disk, or None to use config.yaml"""
+    # Temporary config first (from "Generate Without Saving")
+    try:
+        with open(os.path.join(UPLOAD_DIR, f"{file_id}.tempconfig"), 'r') as f:
+            return parse_temp_config(f.read())
+    except FileNotFoundError:
+        pass
+
+    # Then the preset picked before uploading
+    try:
+        with open(os.path.join(UPLOAD_DIR, f"{file_id}.preset"), 'r') as f:
+            preset_slug = f.read().strip()
+    except FileNotFoundError:
+        return None
+    try:
+        return load_preset_config(preset_slug)
+    except Exception as e:
+        logger.warning("Error loading preset from marker: %s", e)
+        return None
+
+async def resolve_preview_generator(file_id: str) -> PDFGenerator:
+    """Return a generator configured the way an upload should be previewed"""
+    config = get_temp_config(file_id)
+    if config is None:
+        # Not in memory (e.g. after a server restart), so read the upload's
+        # files and its preset, which may mean parsing YAML, off the event loop
+        config = await asyncio.to_thread(read_upload_config, file_id)
+
+    if config is None:
+        # Use backend config.yaml (from saved settings or loaded preset)
+        return get_pdf_generator()
+
+    # Copy the shared generator so the cached config isn't mutated
+    pdf_gen = copy.copy(get_pdf_generator())
+    pdf_gen.config = config
+    return pdf_gen
+
 @app.get("/preview/{file_id}", response_class=HTMLResponse)
 async def preview_markdown(request: Request, file_id: str):
     """Serve styled HTML preview of markdown file"""
     try:
-        markdown_content, filename = get_file_content(file_id)
+        pdf_gen = await resolve_preview_generator(file_id)
 
-        # Check for temporary config first
-        temp_config_path = os.path.join(UPLOAD_DIR, f"{file_id}.tempconfig")
-        preset_marker_path = os.path.join(UPLOAD_DIR, f"{file_id}.preset")
+        # The page only depends on the upload and the config. Keying on the
+        # upload's mtime also makes an expired upload 404 before any cache hit.
+        upload_mtime = os.stat(os.path.join(UPLOAD_DIR, f"{file_id}.meta")).st_mtime_ns
+        cache_key = (file_id, upload_mtime, config_fingerprint(pdf_gen.config))
 
-        if os.path.exists(temp_config_path):
-            # Use temporary config (from "Generate Without Saving")
-            try:
-                with open(temp_config_path, 'r') as f:
-                    temp_config = json.load(f)
+        # Let the browser revalidate a page it already has without re-rendering
+        etag = preview_etag(cache_key)
+        cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=cache_headers)
 
-                if not isinstance(temp_config, dict) or 'custom_classes' not in temp_config:
-                    pdf_gen = PDFGenerator()
-                else:
-                    pdf_gen = PDFGenerator()
-                    pdf_gen.config = temp_config
-            except Exception as e:
-                pdf_gen = PDFGenerator()
-        elif os.path.exists(preset_marker_path):
-            # Use preset config (from preset selection + upload)
-            try:
-                with open(preset_marker_path, 'r') as f:
-                    preset_slug = f.read().strip()
-
-                # Load preset config
-                pdf_gen = PDFGenerator()
-                preset_path = pdf_gen.factory_presets_dir / f"{preset_slug}.yaml"
-                if not preset_path.exists():
-                    preset_path = pdf_gen.user_presets_dir / f"{preset_slug}.yaml"
-
-                if preset_path.exists():
-                    with open(preset_path, 'r') as f:
-                        preset_data = yaml.safe_load(f)
-                    # Remove metadata and apply preset config
-                    preset_data.pop('_metadata', None)
-                    pdf_gen.config = preset_data
-            except Exception as e:
-                print(f"Error loading preset from marker: {e}")
-                pdf_gen = PDFGenerator()
-        else:
-            # Use backend config.yaml (from saved settings or loaded preset)
-            pdf_gen = PDFGenerator()
+        cached_page = _PREVIEW_CACHE.get(cache_key)
+        if cached_page is not None:
+            _PREVIEW_CACHE.move_to_end(cache_key)
+            return HTMLResponse(content=cached_page, headers=cache_headers)
 
-        try:
-            html_body = pdf_gen.markdown_to_html(markdown_content)
-            html_body = pdf_gen.apply_custom_classes(html_body)
-            html_body = pdf_gen.apply_codehilite_wrapper_styling(html_body)
-        except Exception as e:
-            html_body = pdf_gen.markdown_to_html(markdown_content)
+        markdown_content, filename = await asyncio.to_thread(get_file_content, file_id)
+        html_body = await render_markdown(pdf_gen, markdown_content)
 
         original_filename = Path(filename).stem
         codehilite_css = pdf_gen.get_codehilite_css()
 
-        return templates.TemplateResponse(
-            "preview.html",
+        page = _TPL_PREVIEW.render(
             {
-                "request": request,
                 "html_content": html_body,
                 "filename": original_filename,
                 "config": pdf_gen.config,
                 "codehilite_css": codehilite_css
             }
-        )
+        ).encode()
+
+        _PREVIEW_CACHE[cache_key] = page
+        if len(_PREVIEW_CACHE) > _PREVIEW_CACHE_SIZE:
+            _PREVIEW_CACHE.popitem(last=False)
+        return HTMLResponse(content=page, headers=cache_headers)
     except FileNotFoundError:
         return HTMLResponse("<h1>File not found</h1><p>The requested file may have expired or does not exist.</p>", status_code=404)
     except Exception as e:
         return HTMLResponse(f"<h1>Error</h1><p>Failed to load preview: {str(e)}</p>", status_code=500)
 
 @app.get("/theme-preview", response_class=HTMLResponse)
-async def theme_preview(request: Request, current: Optional[str] = None):
+async def theme_preview(request: Request):
     """Display all available Pygments themes with sample code"""
-    pdf_gen = PDFGenerator()
-
-    # Get all available themes
-    available_themes = pdf_gen.get_available_themes()
-
-    # Sample Python code for preview (with syntax highlighting markup)
-    sample_code = '''<span class="k">def</span> <span class="nf">fibonacci</span><span class="p">(</span><span class="n">n</span><span class="p">):</span>
-    <span class="k">if</span> <span class="n">n</span> <span class="o">&lt;=</span> <span class="mi">1</span><span class="p">:</span>
-        <span class="k">return</span> <span class="n">n</span>
-    <span class="k">return</span> <span class="n">fibonacci</span><span class="p">(</span><span class="n">n</span><span class="o">-</span><span class="mi">1</span><span class="p">)</span> <span class="o">+</span> <span class="n">fibonacci</span><span class="p">(</span><span class="n">n</span><span class="o">-</span><span class="mi">2</span><span class="p">)</span>
-
-<span class="nb">print</span><span class="p">(</span><span class="n">fibonacci</span><span class="p">(</span><span class="mi">10</span><span class="p">))</span>'''
-
-    # Generate CSS for each theme with scope prefix
-    themes_with_css = {}
-    for theme in available_themes:
-        try:
-            # Create scope prefix by replacing special characters
-            scope_class = f".theme-{theme.replace('.', '_').replace('-', '_')}"
-            css = pdf_gen.get_codehilite_css(theme, scope_prefix=scope_class)
-            themes_with_css[theme] = css
-        except Exception as e:
-            print(f"Error generating CSS for theme {theme}: {e}")
-            continue
-
-    return templates.TemplateResponse(
-        "theme_preview.html",
-        {
-            "request": request,
-            "themes": themes_with_css,
-            "sample_code": sample_code,
-            "current_theme": current
-        }
-    )
+    # The gallery only changes when the server restarts. It's the same page for
+    # every ?current= theme: the page marks that theme's card itself.
+    page, etag = render_theme_preview()
+    cache_headers = {"ETag": etag, "Cache-Control": "public, max-age=86400"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=cache_headers)
+    return HTMLResponse(content=page, headers=cache_headers)
 
 @app.post("/api/convert")
 async def convert_markdown(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     temp_config: Optional[str] = Form(None),
     preset_slug: Optional[str] = Form(None)
 ):
     try:
         # Validate file type
-        if not file.filename.endswith(('.md', '.markdown')):
-            return JSONResponse(
+        if Path(file.filename).suffix.lower() not in MARKDOWN_EXTENSIONS:
+            return APIResponse(
                 status_code=400,
                 content={"error": "Please upload a valid Markdown file (.md or .markdown)"}
             )
 
-        # Read and store the file
-        markdown_content = await file.read()
-        file_id = save_uploaded_file(markdown_content, file.filename)
+        # Stream the upload to disk without buffering it in memory
+        file_id = await asyncio.to_thread(save_uploaded_file, file.file, file.filename)
+
+        # Forget previous uploads now, and remove their files after the response is sent
+        evict_stale_uploads(file_id)
+        background_tasks.add_task(cleanup_old_files)
 
         # Save temporary config if provided
         if temp_config:
-            temp_config_path = os.path.join(UPLOAD_DIR, f"{file_id}.tempconfig")
-            with open(temp_config_path, 'w') as f:
-                f.write(temp_config)
+            parsed_config = parse_temp_config(temp_config)
+            if parsed_config is not None:
+                store_temp_config(file_id, parsed_config)
+
+                # Keep a compact copy on disk so previews survive a restart
+                temp_config_path = os.path.join(UPLOAD_DIR, f"{file_id}.tempconfig")
+                serialized = json_dumps(parsed_config).decode()
+                await asyncio.to_thread(write_text_file, temp_config_path, serialized)
         # If preset slug provided, save preset marker
         elif preset_slug:
             preset_marker_path = os.path.join(UPLOAD_DIR, f"{file_id}.preset")
-            with open(preset_marker_path, 'w') as f:
-                f.write(preset_slug)
+            await asyncio.to_thread(write_text_file, preset_marker_path, preset_slug)
 
         # Return preview URL instead of PDF
         preview_url = f"/preview/{file_id}"
 
-        return JSONResponse(
+        return APIResponse(
             content={
                 "status": "success",
                 "message": "Markdown file processed successfully",
@@ -320,7 +754,7 @@ async def convert_markdown(
             }
         )
     except Exception as e:
-        return JSONResponse(
+        return APIResponse(
             status_code=500,
             content={"error": str(e)}
         )
@@ -328,108 +762,39 @@ async def convert_markdown(
 # ========== PRESET MANAGEMENT ROUTES ==========
 
 @app.get("/api/presets")
-async def list_presets():
+async def list_presets(pdf_gen: SharedPDFGenerator):
     """List all available presets (factory + user)"""
     try:
-        pdf_gen = PDFGenerator()
-        presets = pdf_gen.list_presets()
-        return JSONResponse(content=presets)
+        presets = await asyncio.to_thread(get_presets, pdf_gen)
+        return APIResponse(content=presets)
     except Exception as e:
-        return JSONResponse(
+        return APIResponse(
             status_code=500,
             content={"error": f"Failed to list presets: {str(e)}"}
         )
 
 @app.post("/api/presets/save")
-async def save_preset(
-    name: str = Form(...),
-    description: str = Form(""),
-    # Add all config fields from the form
-    prose_size: str = Form(...),
-    prose_color: str = Form(""),
-    codehilite_theme: str = Form("default"),
-    codehilite_auto_bg: bool = Form(True),
-    codehilite_custom_bg: str = Form(""),
-    codehilite_wrapper_classes: str = Form(""),
-    h1_classes: str = Form(""),
-    h2_classes: str = Form(""),
-    h3_classes: str = Form(""),
-    h4_classes: str = Form(""),
-    h5_classes: str = Form(""),
-    h6_classes: str = Form(""),
-    p_classes: str = Form(""),
-    a_classes: str = Form(""),
-    code_classes: str = Form(""),
-    pre_classes: str = Form(""),
-    blockquote_classes: str = Form(""),
-    table_classes: str = Form(""),
-    thead_classes: str = Form(""),
-    tbody_classes: str = Form(""),
-    tr_classes: str = Form(""),
-    td_classes: str = Form(""),
-    th_classes: str = Form(""),
-    ul_classes: str = Form(""),
-    ol_classes: str = Form(""),
-    li_classes: str = Form(""),
-    img_classes: str = Form(""),
-    hr_classes: str = Form("")
-):
+async def save_preset(form: Annotated[PresetForm, Form()], pdf_gen: SharedPDFGenerator):
     """Save current form values as a named preset"""
+    name = form.name
+    description = form.description
     try:
-        pdf_gen = PDFGenerator()
-
         # Check if name matches a factory preset (case-insensitive)
-        factory_presets = pdf_gen.list_presets()['factory']
-        factory_names = [p['name'].lower() for p in factory_presets]
-
-        if name.lower() in factory_names:
-            # Find the actual factory preset name (with correct casing) for error message
-            matching_preset = next(p for p in factory_presets if p['name'].lower() == name.lower())
-            return JSONResponse(
+        factory_name = await asyncio.to_thread(get_factory_preset_name, pdf_gen, name)
+        if factory_name is not None:
+            return APIResponse(
                 status_code=400,
-                content={"error": f"Cannot use factory preset name '{matching_preset['name']}'. Please choose a different name."}
+                content={"error": f"Cannot use factory preset name '{factory_name}'. Please choose a different name."}
             )
 
         # Build config from form values
-        config_to_save = {
-            'prose_size': prose_size,
-            'prose_color': prose_color,
-            'codehilite_theme': codehilite_theme,
-            'codehilite_container': {
-                'auto_background': codehilite_auto_bg,
-                'custom_background': codehilite_custom_bg,
-                'wrapper_classes': codehilite_wrapper_classes
-            },
-            'custom_classes': {
-                'h1': h1_classes,
-                'h2': h2_classes,
-                'h3': h3_classes,
-                'h4': h4_classes,
-                'h5': h5_classes,
-                'h6': h6_classes,
-                'p': p_classes,
-                'a': a_classes,
-                'code': code_classes,
-                'pre': pre_classes,
-                'blockquote': blockquote_classes,
-                'table': table_classes,
-                'thead': thead_classes,
-                'tbody': tbody_classes,
-                'tr': tr_classes,
-                'td': td_classes,
-                'th': th_classes,
-                'ul': ul_classes,
-                'ol': ol_classes,
-                'li': li_classes,
-                'img': img_classes,
-                'hr': hr_classes
-            },
-            'pdf_options': pdf_gen.get_default_config()['pdf_options']  # Keep default PDF options
-        }
+        config_to_save = form.to_config()
+        config_to_save['pdf_options'] = pdf_gen.get_default_config()['pdf_options']  # Keep default PDF options
 
-        slug = pdf_gen.save_preset_with_config(name, description, config_to_save)
+        slug = await asyncio.to_thread(pdf_gen.save_preset_with_config, name, description, config_to_save)
+        invalidate_preset_index()
 
-        return JSONResponse(content={
+        return APIResponse(content={
             "status": "success",
             "message": f"Preset '{name}' saved successfully",
             "preset": {
@@ -439,159 +804,136 @@ async def save_preset(
             }
         })
     except ValueError as e:
-        return JSONResponse(
+        return APIResponse(
             status_code=400,
             content={"error": str(e)}
         )
     except Exception as e:
-        return JSONResponse(
+        return APIResponse(
             status_code=500,
             content={"error": f"Failed to save preset: {str(e)}"}
         )
 
 @app.post("/api/presets/load/{slug}")
-async def load_preset(slug: str):
+async def load_preset(slug: str, pdf_gen: SharedPDFGenerator):
     """Load preset config and save to backend config.yaml"""
     try:
-        pdf_gen = PDFGenerator()
-
-        # Find preset file (check factory first, then user)
-        preset_path = pdf_gen.factory_presets_dir / f"{slug}.yaml"
-        if not preset_path.exists():
-            preset_path = pdf_gen.user_presets_dir / f"{slug}.yaml"
-
-        if not preset_path.exists():
+        # Load preset without its metadata (factory presets win over user presets)
+        try:
+            preset_data = await asyncio.to_thread(load_preset_config, slug)
+        except FileNotFoundError:
+            preset_data = None
+        if preset_data is None:
             raise FileNotFoundError(f"Preset '{slug}' not found")
 
-        # Load preset and save to backend config.yaml
-        with open(preset_path, 'r') as f:
-            preset_data = yaml.safe_load(f)
-
-        # Get preset name for message before removing metadata
-        presets = pdf_gen.list_presets()
-        preset_name = slug
-        for preset in presets['factory'] + presets['user']:
-            if preset['slug'] == slug:
-                preset_name = preset['name']
-                break
-
-        # Remove metadata before saving
-        preset_data.pop('_metadata', None)
+        # Get preset name for message
+        preset_name = await asyncio.to_thread(get_preset_name, pdf_gen, slug)
 
         # Update backend config.yaml with loaded preset
-        pdf_gen.config = preset_data
-        pdf_gen.save_config()
+        async with _CONFIG_WRITE_LOCK:
+            pdf_gen.config = preset_data
+            await asyncio.to_thread(pdf_gen.save_config)
+            mark_config_saved(pdf_gen)
 
-        return JSONResponse(content={
+        return APIResponse(content={
             "status": "success",
             "message": f"Preset '{preset_name}' loaded",
             "config": preset_data
         })
     except FileNotFoundError as e:
-        return JSONResponse(
+        return APIResponse(
             status_code=404,
             content={"error": str(e)}
         )
     except Exception as e:
-        return JSONResponse(
+        return APIResponse(
             status_code=500,
             content={"error": f"Failed to load preset: {str(e)}"}
         )
 
 @app.delete("/api/presets/delete/{slug}")
-async def delete_preset(slug: str):
+async def delete_preset(slug: str, pdf_gen: SharedPDFGenerator):
     """Delete user preset (cannot delete factory)"""
     try:
-        pdf_gen = PDFGenerator()
-
         # Check if it's a factory preset
-        presets = pdf_gen.list_presets()
-        for preset in presets['factory']:
-            if preset['slug'] == slug:
-                return JSONResponse(
-                    status_code=403,
-                    content={"error": "Cannot delete factory presets"}
-                )
+        if await asyncio.to_thread(is_factory_preset, pdf_gen, slug):
+            return APIResponse(
+                status_code=403,
+                content={"error": "Cannot delete factory presets"}
+            )
 
-        pdf_gen.delete_preset(slug)
+        await asyncio.to_thread(pdf_gen.delete_preset, slug)
+        invalidate_preset_index()
 
-        return JSONResponse(content={
+        return APIResponse(content={
             "status": "success",
             "message": f"Preset '{slug}' deleted successfully"
         })
     except FileNotFoundError as e:
-        return JSONResponse(
+        return APIResponse(
             status_code=404,
             content={"error": str(e)}
         )
     except Exception as e:
-        return JSONResponse(
+        return APIResponse(
             status_code=500,
             content={"error": f"Failed to delete preset: {str(e)}"}
         )
 
 @app.get("/api/presets/export/{slug}")
-async def export_preset(slug: str):
+async def export_preset(slug: str, pdf_gen: SharedPDFGenerator):
     """Export preset as downloadable YAML file"""
     try:
-        pdf_gen = PDFGenerator()
         preset_path = pdf_gen.export_preset(slug)
 
         # Get preset name for filename
-        presets = pdf_gen.list_presets()
-        preset_name = slug
-        for preset in presets['factory'] + presets['user']:
-            if preset['slug'] == slug:
-                preset_name = preset['name'].lower().replace(' ', '-')
-                break
+        preset_name = await asyncio.to_thread(get_preset_name, pdf_gen, slug)
+        preset_name = preset_name.lower().replace(' ', '-')
 
         filename = f"{preset_name}.md2pdf-preset.yaml"
 
+        # Passing the stat result saves Starlette a threaded os.stat per download
         return FileResponse(
             path=str(preset_path),
             media_type="application/x-yaml",
-            filename=filename
+            filename=filename,
+            stat_result=os.stat(preset_path)
         )
     except FileNotFoundError as e:
-        return JSONResponse(
+        return APIResponse(
             status_code=404,
             content={"error": str(e)}
         )
     except Exception as e:
-        return JSONResponse(
+        return APIResponse(
             status_code=500,
             content={"error": f"Failed to export preset: {str(e)}"}
         )
 
 @app.post("/api/presets/import")
 async def import_preset(
+    pdf_gen: SharedPDFGenerator,
     file: UploadFile = File(...),
     name: Optional[str] = Form(None)
 ):
     """Import preset from uploaded YAML file"""
     try:
         # Validate file extension
-        if not file.filename.endswith(('.yaml', '.yml')):
-            return JSONResponse(
+        if Path(file.filename).suffix.lower() not in YAML_EXTENSIONS:
+            return APIResponse(
                 status_code=400,
                 content={"error": "Please upload a valid YAML file (.yaml or .yml)"}
             )
 
-        # Read file content
-        file_content = await file.read()
-
-        pdf_gen = PDFGenerator()
-        slug = pdf_gen.import_preset(file_content, name)
+        # Let the YAML parser read the spooled upload directly instead of
+        # buffering it into memory first
+        slug = await asyncio.to_thread(pdf_gen.import_preset, file.file, name)
 
         # Get imported preset name
-        presets = pdf_gen.list_presets()
-        imported_name = slug
-        for preset in presets['user']:
-            if preset['slug'] == slug:
-                imported_name = preset['name']
-                break
+        invalidate_preset_index()
+        imported_name = await asyncio.to_thread(get_preset_name, pdf_gen, slug, True)
 
-        return JSONResponse(content={
+        return APIResponse(content={
             "status": "success",
             "message": f"Preset '{imported_name}' imported successfully",
             "preset": {
@@ -600,12 +942,12 @@ async def import_preset(
             }
         })
     except ValueError as e:
-        return JSONResponse(
+        return APIResponse(
             status_code=400,
             content={"error": str(e)}
         )
     except Exception as e:
-        return JSONResponse(
+        return APIResponse(
             status_code=500,
             content={"error": f"Failed to import preset: {str(e)}"}
         )
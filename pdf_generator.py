@@ -1,28 +1,50 @@
 import markdown
-from markdown.extensions import tables, fenced_code, codehilite
 import yaml
 from pathlib import Path
-from typing import Dict, Optional
+from typing import BinaryIO, Dict, Optional, Union
 import os
 import re
+import html
+import json
+import functools
+import threading
+import logging
 from datetime import datetime
+from pygments.formatters import HtmlFormatter
+from pygments.styles import get_all_styles
+from bs4 import BeautifulSoup
+
+# Prefer the libyaml-backed C loader/dumper; fall back to the pure-Python ones
+try:
+    from yaml import CSafeLoader as _YAMLLoader, CSafeDumper as _YAMLDumper
+except ImportError:
+    from yaml import SafeLoader as _YAMLLoader, SafeDumper as _YAMLDumper
+
+logger = logging.getLogger(__name__)
+
+if _YAMLLoader is yaml.SafeLoader:
+    logger.warning("PyYAML was built without libyaml; config and preset parsing will be slow")
+
+# Where the distributed app keeps its config (resolved once per process)
+_APP_SUPPORT_DIR = os.path.expanduser("~/Library/Application Support/md2pdf")
+_APP_CONFIG_PATH = os.path.join(_APP_SUPPORT_DIR, "config.yaml")
 
 class PDFGenerator:
+    # Presets directories already created/populated in this process
+    _initialized_presets_dirs: set = set()
+
     def __init__(self, config_path: str = None):
         if config_path is None:
             # Check for config in Application Support (for distributed app)
-            app_support = os.path.expanduser("~/Library/Application Support/md2pdf")
-            app_config_path = os.path.join(app_support, "config.yaml")
-
-            if os.path.exists(app_config_path):
-                config_path = app_config_path
+            if os.path.exists(_APP_CONFIG_PATH):
+                config_path = _APP_CONFIG_PATH
             elif os.path.exists("config.yaml"):
                 # Development mode - use local config
                 config_path = "config.yaml"
             else:
                 # Create default config in Application Support
-                os.makedirs(app_support, exist_ok=True)
-                config_path = app_config_path
+                os.makedirs(_APP_SUPPORT_DIR, exist_ok=True)
+                config_path = _APP_CONFIG_PATH
                 self._create_default_config(config_path)
 
         self.config_path = Path(config_path)
@@ -35,16 +57,15 @@ class PDFGenerator:
         self._ensure_presets_directory()
 
     def load_config(self, config_path: str) -> Dict:
-        with open(config_path, 'r') as f:
-            config = yaml.safe_load(f)
+        with open(config_path, 'rb') as f:
+            config = yaml.load(f.read(), Loader=_YAMLLoader)
 
         # Migrate old configs: add codehilite_container if missing
         if 'codehilite_container' not in config:
             default_config = self.get_default_config()
             config['codehilite_container'] = default_config['codehilite_container']
             # Save updated config
-            with open(config_path, 'w') as f:
-                yaml.dump(config, f, default_flow_style=False)
+            _dump_yaml(config_path, config)
 
         return config
 
@@ -97,30 +118,48 @@ class PDFGenerator:
     def _create_default_config(self, path: str):
         """Create default config file with academic preset"""
         default_config = self.get_default_config()
-        with open(path, 'w') as f:
-            yaml.dump(default_config, f, default_flow_style=False)
+        try:
+            # 'x' fails if another process created it first, so concurrent
+            # launches don't each rewrite the file
+            _dump_yaml(path, default_config, mode='xb')
+        except FileExistsError:
+            pass
 
     def save_config(self, config_path: str = None):
         if config_path is None:
             config_path = self.config_path
-        with open(config_path, 'w') as f:
-            yaml.dump(self.config, f, default_flow_style=False)
+        # Serialize first, then swap the file in so readers never see a partial config
+        tmp_path = f"{config_path}.tmp"
+        _dump_yaml(tmp_path, self.config)
+        os.replace(tmp_path, config_path)
+
+    # Top-level settings update_config() replaces, and sections it merges into
+    _UPDATABLE_KEYS = ('prose_size', 'prose_color', 'codehilite_theme')
+    _UPDATABLE_SECTIONS = ('codehilite_container', 'custom_classes')
 
     def update_config(self, updates: Dict):
-        if 'prose_size' in updates:
-            self.config['prose_size'] = updates['prose_size']
-        if 'prose_color' in updates:
-            self.config['prose_color'] = updates['prose_color']
-        if 'codehilite_theme' in updates:
-            self.config['codehilite_theme'] = updates['codehilite_theme']
-        if 'codehilite_container' in updates:
-            # Ensure codehilite_container exists in config
-            if 'codehilite_container' not in self.config:
-                self.config['codehilite_container'] = self.get_default_config()['codehilite_container']
-            self.config['codehilite_container'].update(updates['codehilite_container'])
-        if 'custom_classes' in updates:
-            self.config['custom_classes'].update(updates['custom_classes'])
-        self.save_config()
+        changed = False
+        for key in self._UPDATABLE_KEYS:
+            if key in updates and self.config.get(key) != updates[key]:
+                self.config[key] = updates[key]
+                changed = True
+
+        for key in self._UPDATABLE_SECTIONS:
+            if key not in updates:
+                continue
+            section = self.config.get(key)
+            if section is None:
+                # e.g. codehilite_container in a config that predates it
+                section = self.config[key] = self.get_default_config()[key]
+                changed = True
+            for name, value in updates[key].items():
+                if name not in section or section[name] != value:
+                    section[name] = value
+                    changed = True
+
+        # Repeated saves from the UI often change nothing; skip the rewrite then
+        if changed:
+            self.save_config()
 
     def get_codehilite_css(self, theme_name: str = None, scope_prefix: str = None) -> str:
         """Generate CSS for code highlighting from Pygments theme
@@ -129,198 +168,199 @@ class PDFGenerator:
             theme_name: Name of the Pygments theme to use
             scope_prefix: Optional CSS class prefix to scope the styles (e.g., '.theme-monokai')
         """
-        from pygments.formatters import HtmlFormatter
-        import re
-
         if theme_name is None:
             theme_name = self.config.get('codehilite_theme', 'default')
 
-        try:
-            formatter = HtmlFormatter(style=theme_name)
-            css = formatter.get_style_defs('.codehilite')
-
-            # Extract background color from the theme
-            background = getattr(formatter.style, 'background_color', None)
-            if not background:
-                background = '#f6f8fa'  # Light gray fallback
-
-            # Add rules to ensure nested elements match the wrapper background
-            # This prevents TailwindCSS Typography from applying conflicting backgrounds
-            additional_css = f"""
-.codehilite pre {{ background-color: {background} !important; }}
-.codehilite code {{ background-color: transparent; }}
-"""
-
-            full_css = css + additional_css
-
-            # If scope_prefix provided, prepend it to all selectors
-            if scope_prefix:
-                # Remove trailing/leading whitespace from prefix
-                scope_prefix = scope_prefix.strip()
-
-                # Match CSS selectors (everything before the opening brace)
-                # This regex finds patterns like ".codehilite .k {" or ".codehilite {"
-                def add_scope(match):
-                    selector = match.group(1).strip()
-                    # Prepend scope prefix to the selector
-                    return f"{scope_prefix} {selector} {{"
-
-                # Replace all CSS selectors with scoped versions
-                full_css = re.sub(r'([^{}]+)\s*\{', add_scope, full_css)
-
-            return full_css
-        except Exception as e:
-            print(f"Error generating CSS for theme '{theme_name}': {e}")
-            # Fallback to default theme
-            formatter = HtmlFormatter(style='default')
-            return formatter.get_style_defs('.codehilite')
+        return build_codehilite_css(theme_name, scope_prefix)
 
     @staticmethod
     def get_available_themes():
         """Get list of all available Pygments themes"""
-        from pygments.styles import get_all_styles
         return sorted(list(get_all_styles()))
     
     def markdown_to_html(self, markdown_content: str) -> str:
         # Get configured theme
         theme_name = self.config.get('codehilite_theme', 'default')
 
-        md = markdown.Markdown(
-            extensions=[
-                'tables',
-                'fenced_code',
-                'codehilite',
-                'nl2br',
-                'sane_lists',
-                'attr_list',
-                'def_list',
-                'abbr',
-                'footnotes',
-                'toc'
-            ],
-            extension_configs={
-                'codehilite': {
-                    'pygments_style': theme_name,
-                    'noclasses': False  # Generate CSS classes instead of inline styles
-                }
-            }
-        )
-        return md.convert(markdown_content)
+        # Reuse the parser for this theme; reset() clears footnote/TOC state
+        return _get_markdown(theme_name).reset().convert(markdown_content)
     
     def apply_custom_classes(self, html_content: str) -> str:
-        from bs4 import BeautifulSoup
+        # Nothing configured: skip the parse/serialize round trip
+        if not self._custom_classes_by_tag():
+            return html_content
 
         try:
             soup = BeautifulSoup(html_content, 'html.parser')
-            custom_classes = self.config.get('custom_classes', {})
-
-            if not isinstance(custom_classes, dict):
-                print(f"WARNING: custom_classes is not a dict: {type(custom_classes)}")
+            if not self._apply_custom_classes_to_soup(soup):
                 return html_content
 
-            for tag, classes in custom_classes.items():
-                if classes and isinstance(classes, str):
-                    try:
-                        for element in soup.find_all(tag):
-                            existing_classes = element.get('class', [])
-                            if isinstance(existing_classes, str):
-                                existing_classes = existing_classes.split()
-                            new_classes = classes.split()
-                            element['class'] = existing_classes + new_classes
-                    except Exception as e:
-                        print(f"ERROR applying classes to {tag}: {e}")
-                        continue  # Skip this tag and continue with others
-
             result = str(soup)
             if not isinstance(result, str):
-                print(f"WARNING: soup conversion returned non-string: {type(result)}")
+                logger.warning("soup conversion returned non-string: %s", type(result))
                 return html_content  # Return original if conversion fails
             return result
         except Exception as e:
-            print(f"ERROR in apply_custom_classes: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Error in apply_custom_classes: %s", e)
             return html_content  # Return original HTML on error
 
+    def _custom_classes_by_tag(self) -> Optional[Dict[str, list]]:
+        """Split each configured class string once, skipping empty entries
+
+        Returns None if custom_classes is malformed.
+        """
+        custom_classes = self.config.get('custom_classes', {})
+
+        if not isinstance(custom_classes, dict):
+            logger.warning("custom_classes is not a dict: %s", type(custom_classes))
+            return None
+
+        return {
+            tag: classes.split()
+            for tag, classes in custom_classes.items()
+            if classes and isinstance(classes, str)
+        }
+
+    def _apply_custom_classes_to_soup(self, soup) -> bool:
+        """Add the configured custom classes to a parsed document in place
+
+        Returns whether any element was changed (False if custom_classes is malformed).
+        """
+        classes_by_tag = self._custom_classes_by_tag()
+        if not classes_by_tag:
+            return False
+
+        changed = False
+
+        # One walk over the tree instead of a find_all() scan per configured tag
+        for element in soup.find_all(True):
+            new_classes = classes_by_tag.get(element.name)
+            if new_classes is None:
+                continue
+            try:
+                existing_classes = element.get('class', [])
+                if isinstance(existing_classes, str):
+                    existing_classes = existing_classes.split()
+                element['class'] = _merge_classes(existing_classes, new_classes)
+                changed = True
+            except Exception as e:
+                logger.error("Error applying classes to %s: %s", element.name, e)
+                continue  # Skip this element and continue with others
+        return changed
+
     def apply_codehilite_wrapper_styling(self, html_content: str) -> str:
         """Apply Tailwind classes and background color to .codehilite wrapper divs"""
-        from bs4 import BeautifulSoup
-        from pygments.formatters import HtmlFormatter
-        import re
+        # No code blocks, or no classes/background to add: skip the parse/serialize round trip
+        if 'codehilite' not in html_content or not any(self._codehilite_wrapper_settings()):
+            return html_content
 
         try:
             soup = BeautifulSoup(html_content, 'html.parser')
-            container_config = self.config.get('codehilite_container', {})
-
-            # Get wrapper classes
-            wrapper_classes = container_config.get('wrapper_classes', '').strip()
-
-            # Get background color settings
-            auto_bg = container_config.get('auto_background', True)
-            custom_bg = container_config.get('custom_background', '').strip()
-
-            # Determine background color
-            background = None
-            if custom_bg:
-                background = custom_bg
-            elif auto_bg:
-                theme_name = self.config.get('codehilite_theme', 'default')
-                try:
-                    formatter = HtmlFormatter(style=theme_name)
-
-                    # Method 1: Direct attribute access (works for most themes)
-                    background = getattr(formatter.style, 'background_color', None)
-
-                    # Method 2: CSS parsing fallback (extracts from generated CSS)
-                    if not background:
-                        css = formatter.get_style_defs('.codehilite')
-                        # Match background or background-color in .codehilite rule
-                        css_match = re.search(
-                            r'\.codehilite\s*\{[^}]*background(?:-color)?:\s*([#\w]+)',
-                            css
-                        )
-                        if css_match:
-                            background = css_match.group(1)
-
-                    # Final fallback if both methods fail
-                    if not background:
-                        background = '#f6f8fa'  # Light gray fallback
-
-                except Exception as e:
-                    print(f'Warning: Could not extract background for theme "{theme_name}": {e}')
-                    background = '#f6f8fa'
-
-            # Find all .codehilite divs and apply styling
-            for div in soup.find_all('div', class_='codehilite'):
-                # Add Tailwind classes
-                if wrapper_classes:
-                    existing_classes = div.get('class', [])
-                    if isinstance(existing_classes, str):
-                        existing_classes = existing_classes.split()
-                    new_classes = wrapper_classes.split()
-                    div['class'] = existing_classes + new_classes
-
-                # Add inline background style
-                if background:
-                    existing_style = div.get('style', '')
-                    if existing_style and not existing_style.endswith(';'):
-                        existing_style += ';'
-                    div['style'] = f"{existing_style}background-color: {background};"
-
+            if not self._style_codehilite_wrappers(soup):
+                return html_content  # No .codehilite div after all
             return str(soup)
         except Exception as e:
-            print(f"ERROR in apply_codehilite_wrapper_styling: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Error in apply_codehilite_wrapper_styling: %s", e)
             return html_content  # Return original HTML on error
 
+    def postprocess_html(self, html_content: str) -> str:
+        """Apply custom classes and code block styling in a single parse/serialize pass"""
+        classes_by_tag = self._custom_classes_by_tag()
+        # Only resolve the wrapper settings (and theme background) when there are code blocks
+        if 'codehilite' in html_content:
+            wrapper_classes, background = self._codehilite_wrapper_settings()
+        else:
+            wrapper_classes, background = [], None
+        styles_code_blocks = bool(wrapper_classes or background)
+        if not classes_by_tag and not styles_code_blocks:
+            return html_content  # Nothing to apply
+
+        # Markdown's own output is regular enough to rewrite the start tags
+        # directly; documents with raw HTML fall through to BeautifulSoup
+        if classes_by_tag is not None:
+            result = _rewrite_start_tags(html_content, classes_by_tag, wrapper_classes, background)
+            if result is not None:
+                return result
+
+        try:
+            soup = BeautifulSoup(html_content, 'html.parser')
+            classes_applied = self._apply_custom_classes_to_soup(soup)
+            wrappers_styled = self._style_codehilite_wrappers(soup)
+            if not (classes_applied or wrappers_styled):
+                return html_content  # Serializing an unchanged tree is wasted work
+            return str(soup)
+        except Exception as e:
+            logger.warning("Single-pass post-processing failed, applying steps separately: %s", e)
+            return self.apply_codehilite_wrapper_styling(self.apply_custom_classes(html_content))
+
+    def _codehilite_wrapper_settings(self) -> tuple[list, Optional[str]]:
+        """Return the wrapper classes and background color for .codehilite divs"""
+        container_config = self.config.get('codehilite_container', {})
+
+        # Get wrapper classes
+        wrapper_classes = container_config.get('wrapper_classes', '').strip()
+
+        # Get background color settings
+        auto_bg = container_config.get('auto_background', True)
+        custom_bg = container_config.get('custom_background', '').strip()
+
+        # Determine background color
+        background = None
+        if custom_bg:
+            background = custom_bg
+        elif auto_bg:
+            theme_name = self.config.get('codehilite_theme', 'default')
+            background = theme_background_color(theme_name)
+
+        return wrapper_classes.split(), background
+
+    def _style_codehilite_wrappers(self, soup) -> bool:
+        """Add wrapper classes and the background color to .codehilite divs in place
+
+        Returns whether any div was changed.
+        """
+        wrapper_classes, background = self._codehilite_wrapper_settings()
+        if not (wrapper_classes or background):
+            return False
+
+        changed = False
+
+        # Find all .codehilite divs and apply styling
+        for div in soup.find_all('div', class_='codehilite'):
+            # Add Tailwind classes
+            if wrapper_classes:
+                existing_classes = div.get('class', [])
+                if isinstance(existing_classes, str):
+                    existing_classes = existing_classes.split()
+                div['class'] = _merge_classes(existing_classes, wrapper_classes)
+
+            # Add inline background style
+            if background:
+                existing_style = div.get('style', '')
+                if existing_style and not existing_style.endswith(';'):
+                    existing_style += ';'
+                div['style'] = f"{existing_style}background-color: {background};"
+            changed = True
+        return changed
+
     # ========== PRESET MANAGEMENT METHODS ==========
 
     def _ensure_presets_directory(self):
         """Create presets directory structure if it doesn't exist"""
+        # Generators are rebuilt whenever config.yaml changes; set up each
+        # presets directory once per process
+        if self.presets_dir in PDFGenerator._initialized_presets_dirs:
+            return
+
         self.factory_presets_dir.mkdir(parents=True, exist_ok=True)
         self.user_presets_dir.mkdir(parents=True, exist_ok=True)
         self._create_factory_presets()
+        PDFGenerator._initialized_presets_dirs.add(self.presets_dir)
+
+    def restore_presets_directory(self):
+        """Set the presets directories up again after they were deleted or moved"""
+        PDFGenerator._initialized_presets_dirs.discard(self.presets_dir)
+        self._ensure_presets_directory()
 
     def _create_factory_presets(self):
         """Create built-in factory presets if they don't exist"""
@@ -334,8 +374,7 @@ class PDFGenerator:
         for name, config in factory_presets.items():
             preset_path = self.factory_presets_dir / f"{name}.yaml"
             if not preset_path.exists():
-                with open(preset_path, 'w') as f:
-                    yaml.dump(config, f, default_flow_style=False)
+                _dump_yaml(preset_path, config)
 
     @staticmethod
     def _get_factory_default_config() -> dict:
@@ -411,14 +450,14 @@ class PDFGenerator:
         user = []
 
         # Factory presets
-        for preset_file in sorted(self.factory_presets_dir.glob("*.yaml")):
+        for preset_file in _list_preset_files(self.factory_presets_dir):
             preset = self._load_preset_metadata(preset_file)
             preset['is_factory'] = True
             preset['can_delete'] = False
             factory.append(preset)
 
         # User presets
-        for preset_file in sorted(self.user_presets_dir.glob("*.yaml")):
+        for preset_file in _list_preset_files(self.user_presets_dir):
             preset = self._load_preset_metadata(preset_file)
             preset['is_factory'] = False
             preset['can_delete'] = True
@@ -432,8 +471,7 @@ class PDFGenerator:
 
     def _load_preset_metadata(self, preset_path: Path) -> dict:
         """Load preset metadata without loading full config"""
-        with open(preset_path, 'r') as f:
-            data = yaml.safe_load(f)
+        data = load_preset_file(preset_path)
 
         metadata = data.get('_metadata', {})
         slug = preset_path.stem
@@ -459,14 +497,14 @@ class PDFGenerator:
 
         # Create slug from name
         slug = name.lower().replace(' ', '-')
-        slug = re.sub(r'[^a-z0-9-]', '', slug)
+        slug = _SLUG_STRIP_RE.sub('', slug)
 
         # Add metadata
         preset_config = {
             '_metadata': {
                 'name': name,
                 'description': description,
-                'created_at': datetime.now().isoformat(),
+                'created_at': datetime.now().isoformat(timespec='seconds'),
                 'version': '1.0'
             },
             **config  # Use provided config instead of self.config
@@ -474,8 +512,7 @@ class PDFGenerator:
 
         # Save to user presets
         preset_path = self.user_presets_dir / f"{slug}.yaml"
-        with open(preset_path, 'w') as f:
-            yaml.dump(preset_config, f, default_flow_style=False)
+        _dump_yaml(preset_path, preset_config)
 
         return slug
 
@@ -490,8 +527,7 @@ class PDFGenerator:
             raise FileNotFoundError(f"Preset '{slug}' not found")
 
         # Load preset
-        with open(preset_path, 'r') as f:
-            preset_data = yaml.safe_load(f)
+        preset_data = load_preset_file(preset_path)
 
         # Remove metadata before applying
         preset_data.pop('_metadata', None)
@@ -510,6 +546,7 @@ class PDFGenerator:
             raise FileNotFoundError(f"Preset '{slug}' not found")
 
         preset_path.unlink()
+        preset_json_cache_path(preset_path).unlink(missing_ok=True)
 
     def export_preset(self, slug: str) -> Path:
         """Get path to preset file for export"""
@@ -523,11 +560,11 @@ class PDFGenerator:
 
         return preset_path
 
-    def import_preset(self, file_content: bytes, name: str = None) -> str:
-        """Import preset from uploaded YAML file"""
+    def import_preset(self, file_content: Union[bytes, BinaryIO], name: str = None) -> str:
+        """Import preset from uploaded YAML file (raw bytes or a binary stream)"""
         # Parse YAML
         try:
-            preset_data = yaml.safe_load(file_content)
+            preset_data = yaml.load(file_content, Loader=_YAMLLoader)
         except yaml.YAMLError as e:
             raise ValueError(f"Invalid YAML file: {e}")
 
@@ -543,16 +580,15 @@ class PDFGenerator:
         if '_metadata' not in preset_data:
             preset_data['_metadata'] = {}
         preset_data['_metadata']['name'] = name
-        preset_data['_metadata']['created_at'] = datetime.now().isoformat()
+        preset_data['_metadata']['created_at'] = datetime.now().isoformat(timespec='seconds')
 
         # Create slug from name
         slug = name.lower().replace(' ', '-')
-        slug = re.sub(r'[^a-z0-9-]', '', slug)
+        slug = _SLUG_STRIP_RE.sub('', slug)
 
         # Save as new preset
         preset_path = self.user_presets_dir / f"{slug}.yaml"
-        with open(preset_path, 'w') as f:
-            yaml.dump(preset_data, f, default_flow_style=False)
+        _dump_yaml(preset_path, preset_data)
 
         return slug
 
@@ -566,6 +602,10 @@ class PDFGenerator:
                 raise ValueError(f"Invalid preset: missing required field '{field}'")
 
 
+# Characters allowed in a preset name, and what's stripped when slugifying it
+_PRESET_NAME_RE = re.compile(r'^[a-zA-Z0-9\s_-]+$')
+_SLUG_STRIP_RE = re.compile(r'[^a-z0-9-]')
+
 def validate_preset_name(name: str) -> tuple[bool, str]:
     """Validate preset name. Returns (is_valid, error_message)"""
     if not name or len(name) == 0:
@@ -575,7 +615,7 @@ def validate_preset_name(name: str) -> tuple[bool, str]:
         return False, "Preset name too long (max 50 characters)"
 
     # Sanitize: only alphanumeric, dash, underscore, space
-    if not re.match(r'^[a-zA-Z0-9\s_-]+$', name):
+    if not _PRESET_NAME_RE.match(name):
         return False, "Invalid characters in preset name (use letters, numbers, spaces, dashes, underscores)"
 
     # Prevent directory traversal
@@ -587,4 +627,274 @@ def validate_preset_name(name: str) -> tuple[bool, str]:
     if name.lower() in forbidden:
         return False, f"'{name}' is a reserved name"
 
-    return True, ""
\ No newline at end of file
+    return True, ""
+
+
+# A start tag whose attributes are all double-quoted (or bare), as Python-Markdown
+# serializes them
+_START_TAG_RE = re.compile(r'<([a-zA-Z][a-zA-Z0-9]*)((?:\s+[^\s"\'<>/=]+(?:="[^"<>]*")?)*)(\s*/?)>')
+_END_TAG_RE = re.compile(r'</[a-zA-Z][a-zA-Z0-9]*\s*>')
+# One attribute of such a tag: its name and, unless bare, its double-quoted value
+_ATTR_RE = re.compile(r'\s+([^\s"\'<>/=]+)(?:="([^"<>]*)")?')
+# Content that must not be rewritten as if it were markup
+_RAW_TEXT_RE = re.compile(r'<(?:script|style|textarea|title)\b', re.IGNORECASE)
+
+def _merge_classes(existing: list, new: list) -> list:
+    """Append new classes to existing ones, dropping duplicates but keeping order"""
+    return list(dict.fromkeys([*existing, *new]))
+
+class _NotPlainMarkup(Exception):
+    """Raised inside _rewrite_start_tags() when a tag needs the BeautifulSoup path"""
+
+def _rewrite_start_tags(html_content: str, classes_by_tag: Dict[str, list],
+                        wrapper_classes: list, background: Optional[str]) -> Optional[str]:
+    """Apply custom classes and .codehilite styling with a regex over the start tags
+
+    Produces the same markup as the BeautifulSoup path without building a tree.
+    Returns None when the HTML isn't plain generated markup (comments, raw text
+    elements, single-quoted attributes, repeated class/style attributes, stray
+    '<'), so the caller can fall back.
+    """
+    if _RAW_TEXT_RE.search(html_content):
+        return None
+
+    tag_count = 0
+
+    def rewrite(match):
+        nonlocal tag_count
+        tag_count += 1
+        name, attrs, closing = match.groups()
+        name = name.lower()
+
+        new_classes = classes_by_tag.get(name)
+        if new_classes is None and name != 'div':
+            return match.group(0)
+
+        # Split the attributes into real name="value" pairs so a ' class ' or
+        # ' style ' inside another attribute's value is never mistaken for one
+        parts = []
+        class_index = style_index = None
+        for attr in _ATTR_RE.finditer(attrs):
+            attr_name = attr.group(1).lower()
+            if attr_name == 'class':
+                if class_index is not None:
+                    raise _NotPlainMarkup
+                class_index = len(parts)
+            elif attr_name == 'style':
+                if style_index is not None:
+                    raise _NotPlainMarkup
+                style_index = len(parts)
+            parts.append(attr)
+
+        classes = (parts[class_index].group(2) or '').split() if class_index is not None else []
+        added = list(new_classes) if new_classes else []
+
+        styled = name == 'div' and background and 'codehilite' in classes + added
+        if name == 'div' and 'codehilite' in classes + added:
+            added += wrapper_classes
+
+        if not added and not styled:
+            return match.group(0)
+
+        parts = [attr.group(0) for attr in parts]
+        if added:
+            class_value = ' '.join(_merge_classes(classes, [html.escape(c) for c in added]))
+            if class_index is not None:
+                parts[class_index] = f' class="{class_value}"'
+            else:
+                parts.append(f' class="{class_value}"')
+        if styled:
+            existing_style = ''
+            if style_index is not None:
+                existing_style = _ATTR_RE.match(parts[style_index]).group(2) or ''
+            if existing_style and not existing_style.endswith(';'):
+                existing_style += ';'
+            style_attr = f' style="{existing_style}background-color: {html.escape(background)};"'
+            if style_index is not None:
+                parts[style_index] = style_attr
+            else:
+                parts.append(style_attr)
+        return f'<{name}{"".join(parts)}{closing}>'
+
+    try:
+        result = _START_TAG_RE.sub(rewrite, html_content)
+    except _NotPlainMarkup:
+        return None
+
+    # Every '<' must have been a well-formed start tag or an end tag
+    if tag_count + len(_END_TAG_RE.findall(html_content)) != html_content.count('<'):
+        return None
+    return result
+
+@functools.cache
+def _pygments_style_names() -> frozenset:
+    """Names of the installed Pygments styles"""
+    return frozenset(get_all_styles())
+
+def _build_markdown(theme_name: str) -> markdown.Markdown:
+    """Create a Markdown instance that highlights code with a Pygments theme"""
+    return markdown.Markdown(
+        extensions=[
+            'tables',
+            'fenced_code',
+            'codehilite',
+            'nl2br',
+            'sane_lists',
+            'attr_list',
+            'def_list',
+            'abbr',
+            'footnotes',
+            'toc'
+        ],
+        extension_configs={
+            'codehilite': {
+                'pygments_style': theme_name,
+                'noclasses': False  # Generate CSS classes instead of inline styles
+            }
+        }
+    )
+
+# Building a Markdown instance registers every extension, which costs more than
+# converting a short document. Instances aren't thread-safe, so each thread
+# keeps its own, one per Pygments theme.
+_MD_LOCAL = threading.local()
+
+def _get_markdown(theme_name: str) -> markdown.Markdown:
+    """Return this thread's Markdown instance for a code highlighting theme"""
+    # Theme names come from client configs and imported presets: only installed
+    # styles are cached, so bogus names can't grow the per-thread cache
+    if theme_name not in _pygments_style_names():
+        return _build_markdown(theme_name)
+
+    instances = getattr(_MD_LOCAL, 'instances', None)
+    if instances is None:
+        instances = _MD_LOCAL.instances = {}
+
+    md = instances.get(theme_name)
+    if md is None:
+        md = instances[theme_name] = _build_markdown(theme_name)
+    return md
+
+def _list_preset_files(directory: Path) -> list:
+    """Return the .yaml files in a presets directory, sorted by path"""
+    # scandir's entries already know whether they're files, so no stat per name
+    try:
+        with os.scandir(directory) as entries:
+            return sorted(Path(entry.path) for entry in entries
+                          if entry.name.endswith('.yaml') and entry.is_file())
+    except FileNotFoundError:
+        return []
+
+def _dump_yaml(path: Union[str, Path], data: dict, mode: str = 'wb'):
+    """Write data as block-style YAML, letting libyaml emit the UTF-8 bytes directly"""
+    with open(path, mode) as f:
+        yaml.dump(data, f, Dumper=_YAMLDumper, default_flow_style=False, encoding='utf-8')
+
+def preset_json_cache_path(preset_path: Path) -> Path:
+    """Path of the hidden JSON copy kept next to a preset YAML file"""
+    return preset_path.with_name(f".{preset_path.stem}.json")
+
+def load_preset_file(preset_path: Path) -> dict:
+    """Load a preset YAML file, via its JSON copy when that is up to date
+
+    JSON parses much faster than YAML, so the parsed preset is written next to
+    the YAML file and reused until the YAML file is modified again.
+    """
+    cache_path = preset_json_cache_path(preset_path)
+    try:
+        if cache_path.stat().st_mtime_ns >= preset_path.stat().st_mtime_ns:
+            with open(cache_path, 'rb') as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass  # No usable cache, parse the YAML
+
+    with open(preset_path, 'rb') as f:
+        data = yaml.load(f.read(), Loader=_YAMLLoader)
+
+    try:
+        tmp_path = cache_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, default=str)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.debug("Could not write preset cache %s: %s", cache_path, e)
+
+    return data
+
+
+# Matches a CSS selector list up to its opening brace, e.g. ".codehilite .k {"
+_CSS_SELECTOR_RE = re.compile(r'([^{}]+)\s*\{')
+
+# Matches background or background-color in the .codehilite rule
+_CODEHILITE_BG_RE = re.compile(r'\.codehilite\s*\{[^}]*background(?:-color)?:\s*([#\w]+)')
+
+@functools.lru_cache(maxsize=64)
+def theme_background_color(theme_name: str) -> str:
+    """Return (and cache) the code block background color of a Pygments theme"""
+    try:
+        formatter = HtmlFormatter(style=theme_name)
+
+        # Method 1: Direct attribute access (works for most themes)
+        background = getattr(formatter.style, 'background_color', None)
+
+        # Method 2: CSS parsing fallback (extracts from generated CSS)
+        if not background:
+            css = formatter.get_style_defs('.codehilite')
+            css_match = _CODEHILITE_BG_RE.search(css)
+            if css_match:
+                background = css_match.group(1)
+
+        # Final fallback if both methods fail
+        return background or '#f6f8fa'  # Light gray fallback
+
+    except Exception as e:
+        logger.warning('Could not extract background for theme "%s": %s', theme_name, e)
+        return '#f6f8fa'
+
+@functools.lru_cache(maxsize=128)
+def build_codehilite_css(theme_name: str, scope_prefix: Optional[str] = None) -> str:
+    """Generate (and cache) code highlighting CSS for a Pygments theme
+
+    Args:
+        theme_name: Name of the Pygments theme to use
+        scope_prefix: Optional CSS class prefix to scope the styles (e.g., '.theme-monokai')
+    """
+    try:
+        formatter = HtmlFormatter(style=theme_name)
+        css = formatter.get_style_defs('.codehilite')
+
+        # Extract background color from the theme
+        background = getattr(formatter.style, 'background_color', None)
+        if not background:
+            background = '#f6f8fa'  # Light gray fallback
+
+        # Add rules to ensure nested elements match the wrapper background
+        # This prevents TailwindCSS Typography from applying conflicting backgrounds
+        additional_css = f"""
+.codehilite pre {{ background-color: {background} !important; }}
+.codehilite code {{ background-color: transparent; }}
+"""
+
+        full_css = css + additional_css
+
+        # If scope_prefix provided, prepend it to all selectors
+        if scope_prefix:
+            # Remove trailing/leading whitespace from prefix
+            scope_prefix = scope_prefix.strip()
+
+            # Match CSS selectors (everything before the opening brace)
+            # This regex finds patterns like ".codehilite .k {" or ".codehilite {"
+            def add_scope(match):
+                selector = match.group(1).strip()
+                # Prepend scope prefix to the selector
+                return f"{scope_prefix} {selector} {{"
+
+            # Replace all CSS selectors with scoped versions
+            full_css = _CSS_SELECTOR_RE.sub(add_scope, full_css)
+
+        return full_css
+    except Exception as e:
+        logger.warning("Error generating CSS for theme '%s': %s", theme_name, e)
+        # Fallback to default theme
+        formatter = HtmlFormatter(style='default')
+        return formatter.get_style_defs('.codehilite')
@@ -2,11 +2,11 @@ from setuptools import setup
 
 APP = ['main.py']
 DATA_FILES = [
-    ('templates', ['templates/index.html', 'templates/preview.html'])
+    ('templates', ['templates/index.html', 'templates/preview.html', 'templates/theme_preview.html'])
 ]
 OPTIONS = {
     'argv_emulation': False,
-    'packages': ['uvicorn', 'fastapi', 'jinja2', 'markdown', 'yaml', 'bs4', 'json', 'uuid', 'os', 'datetime'],
+    'packages': ['uvicorn', 'fastapi', 'jinja2', 'markdown', 'yaml', 'bs4', 'json', 'secrets', 'os', 'datetime'],
     'includes': ['uvicorn.logging', 'uvicorn.loops', 'uvicorn.loops.auto', 'uvicorn.protocols', 'uvicorn.protocols.http', 'uvicorn.protocols.http.auto', 'uvicorn.protocols.websockets', 'uvicorn.protocols.websockets.auto', 'uvicorn.lifespan', 'uvicorn.lifespan.on'],
     'plist': {
         'CFBundleName': 'MD2PDF',
@@ -0,0 +1,53 @@
+"""Regression tests for PDFGenerator.postprocess_html()
+
+postprocess_html() rewrites start tags with a regex when the markup is plain
+enough and falls back to BeautifulSoup otherwise. Both paths must add the same
+classes and styles, and only to real class/style attributes.
+"""
+import pytest
+import yaml
+
+from pdf_generator import PDFGenerator
+
+
+@pytest.fixture
+def gen(tmp_path):
+    """Generator with a throwaway config, so tests never touch a real one"""
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(yaml.safe_dump(PDFGenerator.get_default_config()))
+    gen = PDFGenerator(str(config_path))
+    gen.config['custom_classes'].update(a='underline', p='text-lg', div='box', h1='a b a')
+    gen.config['codehilite_container'].update(wrapper_classes='p-4 codehilite', custom_background='#fff')
+    return gen
+
+
+@pytest.mark.parametrize("html_content, expected", [
+    # "class" inside another attribute's value is not a class attribute
+    ('<p><a href="http://u" title="first class tickets">x</a></p>',
+     '<p class="text-lg"><a href="http://u" title="first class tickets" class="underline">x</a></p>'),
+    ('<p title="first class citizen">para<br /></p>',
+     '<p title="first class citizen" class="text-lg">para<br /></p>'),
+    ('<p title="class=&quot;x&quot; style">t</p>',
+     '<p title="class=&quot;x&quot; style" class="text-lg">t</p>'),
+    # ...and neither is "style"
+    ('<div class="codehilite" title="x style y"><pre>c</pre></div>',
+     '<div class="codehilite box p-4" title="x style y" style="background-color: #fff;"><pre>c</pre></div>'),
+    # An existing style is extended in place
+    ('<div style="color:red" class="codehilite">c</div>',
+     '<div style="color:red;background-color: #fff;" class="codehilite box p-4">c</div>'),
+    # Attribute names are case-insensitive
+    ('<p CLASS="x">t</p>', '<p class="x text-lg">t</p>'),
+    # Repeated attributes go through BeautifulSoup, which keeps the last one
+    ('<p class="a" class="b">t</p>', '<p class="b text-lg">t</p>'),
+    # Classes already present aren't added twice
+    ('<h1 class="b c">T</h1>', '<h1 class="b c a">T</h1>'),
+])
+def test_postprocess_html(gen, html_content, expected):
+    assert gen.postprocess_html(html_content) == expected
+
+
+def test_postprocess_html_styles_code_blocks(gen):
+    html_content = gen.markdown_to_html('# T\n\n```python\nprint(1)\n```\n')
+    result = gen.postprocess_html(html_content)
+    assert '<h1 id="t" class="a b">T</h1>' in result
+    assert '<div class="codehilite box p-4" style="background-color: #fff;">' in result